@@ -4,7 +4,16 @@ import os
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "goodbooks")
 
-client = MongoClient(MONGO_URI)
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=200,
+    minPoolSize=10,
+    compressors="zstd,zlib",
+    serverSelectionTimeoutMS=3000,
+    socketTimeoutMS=10000,
+    retryWrites=True,
+    w=1
+)
 db = client[DB_NAME]
 
 def get_database():
@@ -1,16 +1,61 @@
 import pandas as pd
 from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from concurrent.futures import ProcessPoolExecutor
+import gc
 import os
 import sys
 
+# Rows read from the CSV per chunk
+CHUNK_SIZE = 50000
+
+# Upsert operations per bulk_write call
+BULK_WRITE_SIZE = 1000
+
+# Natural unique key of each collection, used to match documents on upsert
+COLLECTION_KEYS = {
+    "books": ["book_id"],
+    "ratings": ["user_id", "book_id"],
+    "tags": ["tag_id"],
+    "book_tags": ["goodreads_book_id", "tag_id"],
+    "to_read": ["user_id", "book_id"]
+}
+
+# Connection settings shared by the main process and every loader worker. Each
+# process writes sequentially, so a small pool with no idle floor is enough, and
+# there is no socket timeout so long operations like the tag count $merge can finish.
+CLIENT_OPTIONS = {
+    "maxPoolSize": 10,
+    "minPoolSize": 0,
+    "compressors": "zstd,zlib",
+    "serverSelectionTimeoutMS": 30000,
+    "socketTimeoutMS": None,
+    "retryWrites": True,
+    "w": 1
+}
+
+# Force a garbage collection every N chunks to limit heap fragmentation
+GC_EVERY_N_CHUNKS = 10
+
 def create_indexes(db):
     """Create required indexes"""
     print("Creating indexes...")
     
     # Books indexes
     db.books.create_index([("title", 1), ("authors", 1)])
-    db.books.create_index([("average_rating", -1)])
     db.books.create_index([("book_id", 1)], unique=True)
+    db.books.create_index([("title", "text"), ("authors", "text")])
+    db.books.create_index(
+        [("title", 1)],
+        name="title_prefix_ci",
+        collation={"locale": "en", "strength": 2}
+    )
+    
+    # Keyset pagination indexes, one per /books sort option
+    db.books.create_index([("average_rating", -1), ("book_id", -1)])
+    db.books.create_index([("ratings_count", -1), ("book_id", -1)])
+    db.books.create_index([("original_publication_year", -1), ("book_id", -1)])
+    db.books.create_index([("title", 1), ("book_id", 1)])
     
     # Ratings indexes
     db.ratings.create_index([("book_id", 1)])
@@ -19,48 +64,103 @@ def create_indexes(db):
     # Tags indexes
     db.tags.create_index([("tag_id", 1)], unique=True)
     db.tags.create_index([("tag_name", 1)])
+    db.tags.create_index([("book_count", -1)])
     
     # Book tags indexes
     db.book_tags.create_index([("tag_id", 1)])
     db.book_tags.create_index([("goodreads_book_id", 1)])
+    db.book_tags.create_index([("goodreads_book_id", 1), ("tag_id", 1)])
     
     # To read indexes
     db.to_read.create_index([("user_id", 1), ("book_id", 1)], unique=True)
     
     print("Indexes created successfully")
 
+def update_tag_book_counts(db):
+    """Denormalize the number of book links per tag onto the tags collection"""
+    print("Updating tag book counts...")
+    
+    db.book_tags.aggregate([
+        {"$group": {"_id": "$tag_id", "book_count": {"$sum": 1}}},
+        {"$project": {"_id": 0, "tag_id": "$_id", "book_count": 1}},
+        {"$merge": {
+            "into": "tags",
+            "on": "tag_id",
+            "whenMatched": "merge",
+            "whenNotMatched": "discard"
+        }}
+    ])
+    
+    # Tags without any book links never appear in the $group output
+    db.tags.update_many({"book_count": {"$exists": False}}, {"$set": {"book_count": 0}})
+    
+    print("Tag book counts updated successfully")
+
 def load_collection(db, collection_name, url, dtype=None):
-    """Load CSV data into MongoDB collection"""
+    """Stream CSV data into MongoDB collection as batched upserts"""
     print(f"Loading {collection_name}...")
     
+    keys = COLLECTION_KEYS[collection_name]
+    
     try:
-        df = pd.read_csv(url, dtype=dtype)
-        
-        # Convert NaN to None for MongoDB compatibility
-        df = df.where(pd.notnull(df), None)
+        reader = pd.read_csv(url, dtype=dtype, chunksize=CHUNK_SIZE, iterator=True)
         
-        records = df.to_dict('records')
+        upserted = 0
+        modified = 0
+        failed = 0
+        for chunk_num, chunk in enumerate(reader, start=1):
+            # Convert NaN to None for MongoDB compatibility, copying only columns that have gaps
+            for col in chunk.columns[chunk.isna().any()]:
+                chunk[col] = chunk[col].astype(object).where(chunk[col].notna(), None)
+            records = chunk.to_dict('records')
+            
+            for start in range(0, len(records), BULK_WRITE_SIZE):
+                ops = [
+                    UpdateOne({k: rec[k] for k in keys}, {"$set": rec}, upsert=True)
+                    for rec in records[start:start + BULK_WRITE_SIZE]
+                ]
+                try:
+                    result = db[collection_name].bulk_write(ops, ordered=False)
+                    upserted += result.upserted_count
+                    modified += result.modified_count
+                except BulkWriteError as e:
+                    # Keep going with the rest of the batch, but fail the collection at the end
+                    upserted += e.details.get("nUpserted", 0)
+                    modified += e.details.get("nModified", 0)
+                    failed += len(e.details.get("writeErrors", []))
+                    print(f"  Failed to write {len(e.details.get('writeErrors', []))} records in chunk {chunk_num}")
+            
+            del chunk, records
+            if chunk_num % GC_EVERY_N_CHUNKS == 0:
+                gc.collect()
         
-        # Clear existing data
-        db[collection_name].delete_many({})
-        
-        # Insert new data
-        if records:
-            result = db[collection_name].insert_many(records)
-            print(f"  Inserted {len(result.inserted_ids)} records")
+        print(f"  Upserted {upserted} records, updated {modified} records")
         
     except Exception as e:
         print(f"Error loading {collection_name}: {str(e)}")
         return False
     
+    if failed:
+        print(f"Error loading {collection_name}: {failed} records failed to write")
+        return False
+    
     return True
 
+def load_collection_worker(collection_name, url, dtype, mongo_uri, db_name):
+    """Load one collection in a worker process over its own MongoClient"""
+    # MongoClient is not fork-safe, so each process connects for itself
+    client = MongoClient(mongo_uri, **CLIENT_OPTIONS)
+    try:
+        return load_collection(client[db_name], collection_name, url, dtype)
+    finally:
+        client.close()
+
 def main():
     """Main ingestion function"""
     MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
     DB_NAME = os.getenv("DB_NAME", "goodbooks")
     
-    client = MongoClient(MONGO_URI)
+    client = MongoClient(MONGO_URI, **CLIENT_OPTIONS)
     db = client[DB_NAME]
     
     print("Starting data ingestion...")
@@ -102,13 +202,24 @@ def main():
         ("to_read", f"{base_url}to_read.csv")
     ]
     
-    success_count = 0
-    for collection_name, url in collections:
-        if load_collection(db, collection_name, url, dtypes.get(collection_name)):
-            success_count += 1
+    # Indexes on the upsert keys must exist before loading so each match is an index seek
+    create_indexes(db)
+    
+    # Each collection is fetched, parsed and written independently, so load them in parallel
+    names = [name for name, _ in collections]
+    with ProcessPoolExecutor(max_workers=len(collections)) as executor:
+        results = executor.map(
+            load_collection_worker,
+            names,
+            [url for _, url in collections],
+            [dtypes.get(name) for name in names],
+            [MONGO_URI] * len(collections),
+            [DB_NAME] * len(collections)
+        )
+        success_count = sum(1 for loaded in results if loaded)
     
     if success_count == len(collections):
-        create_indexes(db)
+        update_tag_book_counts(db)
         print("Data ingestion completed successfully!")
     else:
         print(f"Data ingestion completed with errors. {success_count}/{len(collections)} collections loaded.")
@@ -1,47 +1,146 @@
-﻿from fastapi import FastAPI, Query, HTTPException, Depends, Request, status, Header
+﻿from fastapi import FastAPI, Query, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 import time
 import logging
+import logging.handlers
+import atexit
+import queue
 import json
+import orjson
 import os
+import base64
+import hashlib
+import hmac
+from contextlib import asynccontextmanager
 from datetime import datetime
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from rate_limiter import rate_limit_middleware
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Hand records to a background thread so log I/O never blocks the event loop
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Database connection
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "goodbooks")
+API_KEY = os.getenv("API_KEY", "dev-key-123")
+
+# Set up in lifespan: Motor binds to the event loop that first uses it, so the
+# client has to be created on the loop that serves requests
+client = None
+db = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db
+    client = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=200,
+        minPoolSize=10,
+        compressors="zstd,zlib",
+        serverSelectionTimeoutMS=3000,
+        socketTimeoutMS=10000,
+        retryWrites=True,
+        w=1
+    )
+    db = client[DB_NAME]
+    
+    yield
+    
+    client.close()
+
 app = FastAPI(
     title="GoodBooks API",
     description="A REST API for book ratings and recommendations",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Digest the key once so each check is a fixed-length constant-time compare
+API_KEY_HASH = hashlib.sha256(API_KEY.encode()).digest()
 
-# Database connection
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-DB_NAME = os.getenv("DB_NAME", "goodbooks")
-API_KEY = os.getenv("API_KEY", "dev-key-123")
+# (method, path) pairs that require a valid x-api-key header
+PROTECTED_ROUTES = {("POST", "/ratings")}
+
+# Fields returned for books in list responses
+BOOK_LIST_FIELDS = {
+    "_id": 0,
+    "book_id": 1,
+    "title": 1,
+    "authors": 1,
+    "average_rating": 1,
+    "ratings_count": 1,
+    "original_publication_year": 1,
+    "image_url": 1
+}
+
+# Case-insensitive collation matching the title prefix index
+TITLE_COLLATION = {"locale": "en", "strength": 2}
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
+# Keyset pagination helpers
+def encode_cursor(doc, sort_field: str) -> str:
+    """Encode the (sort value, book_id) of the last document on a page as an opaque token"""
+    payload = json.dumps([doc.get(sort_field), doc["book_id"]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
 
-# Auth dependency
-async def require_api_key(x_api_key: str = Header(...)):
-    if x_api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    return x_api_key
+def decode_cursor(cursor: str):
+    try:
+        value, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Only plain scalars may reach the filter, never objects that could carry query operators
+    if isinstance(book_id, bool) or not isinstance(book_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if isinstance(value, bool) or not (value is None or isinstance(value, (str, int, float))):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, book_id
+
+def build_keyset_filter(sort_field: str, sort_direction: int, cursor: str) -> dict:
+    """Match documents strictly after the cursor position in (sort_field, book_id) order"""
+    value, book_id = decode_cursor(cursor)
+    op = "$lt" if sort_direction == -1 else "$gt"
+    
+    # Nulls sort before every other value, so they come first in asc and last in desc
+    if value is None:
+        if sort_direction == -1:
+            return {sort_field: None, "book_id": {op: book_id}}
+        return {"$or": [
+            {sort_field: None, "book_id": {op: book_id}},
+            {sort_field: {"$ne": None}}
+        ]}
+    
+    conditions = [
+        {sort_field: {op: value}},
+        {sort_field: value, "book_id": {op: book_id}}
+    ]
+    if sort_direction == -1:
+        conditions.append({sort_field: None})
+    return {"$or": conditions}
+
+# API key middleware
+@app.middleware("http")
+async def require_api_key(request: Request, call_next):
+    if (request.method, request.url.path) in PROTECTED_ROUTES:
+        key_hash = hashlib.sha256(request.headers.get("x-api-key", "").encode()).digest()
+        if not hmac.compare_digest(key_hash, API_KEY_HASH):
+            return JSONResponse(status_code=401, content={"detail": "Invalid API key"})
+    return await call_next(request)
+
+# Rate limiting middleware, registered inside request logging so 429s are logged
+app.middleware("http")(rate_limit_middleware)
 
 # Request logging middleware
 @app.middleware("http")
@@ -57,12 +156,21 @@ async def log_requests(request: Request, call_next):
         "status_code": response.status_code,
         "latency_ms": process_time,
         "client_ip": request.client.host if request.client else None,
-        "timestamp": datetime.now().isoformat()
+        "ts": int(start_time * 1000)
     }
     
-    logger.info(json.dumps(log_data))
+    logger.info(orjson.dumps(log_data).decode())
     return response
 
+# CORS middleware, added last so it is outermost and also covers 401/429 responses
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # Pydantic models
 class RatingIn(BaseModel):
     user_id: int
@@ -71,9 +179,11 @@ class RatingIn(BaseModel):
 
 class PaginatedResponse(BaseModel):
     items: List[Any]
-    page: int
+    page: Optional[int] = None
     page_size: int
-    total: int
+    total: Optional[int] = None
+    has_more: bool = False
+    next_cursor: Optional[str] = None
 
 class RatingSummary(BaseModel):
     book_id: int
@@ -81,41 +191,58 @@ class RatingSummary(BaseModel):
     ratings_count: int
     histogram: Dict[int, int]
 
+# Short-lived caches so frequent probes and scrapers don't each hit MongoDB
+HEALTH_CACHE_TTL = 2
+METRICS_CACHE_TTL = 10
+_health_cache = {"t": 0, "v": None}
+_metrics_cache = {"t": 0, "v": None}
+
 # Health check with MongoDB ping
 @app.get("/healthz")
 async def health_check():
+    if time.time() - _health_cache["t"] < HEALTH_CACHE_TTL:
+        return _health_cache["v"]
+    
     try:
-        db.command('ping')
-        return {
-            "status": "healthy", 
-            "database": "connected",
-            "timestamp": datetime.now().isoformat()
-        }
+        await db.command('ping')
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail=f"Database connection failed: {str(e)}"
         )
+    
+    health = {
+        "status": "healthy", 
+        "database": "connected",
+        "timestamp": datetime.now().isoformat()
+    }
+    _health_cache["t"], _health_cache["v"] = time.time(), health
+    return health
 
 # Metrics endpoint
 @app.get("/metrics")
 async def get_metrics():
+    if time.time() - _metrics_cache["t"] < METRICS_CACHE_TTL:
+        return _metrics_cache["v"]
+    
     metrics = {
         "timestamp": datetime.now().isoformat(),
         "collections": {
-            "books": db.books.count_documents({}),
-            "ratings": db.ratings.count_documents({}),
-            "tags": db.tags.count_documents({}),
-            "book_tags": db.book_tags.count_documents({}),
-            "to_read": db.to_read.count_documents({})
+            "books": await db.books.estimated_document_count(),
+            "ratings": await db.ratings.estimated_document_count(),
+            "tags": await db.tags.estimated_document_count(),
+            "book_tags": await db.book_tags.estimated_document_count(),
+            "to_read": await db.to_read.estimated_document_count()
         }
     }
+    _metrics_cache["t"], _metrics_cache["v"] = time.time(), metrics
     return metrics
 
 # Books endpoints
 @app.get("/books", response_model=PaginatedResponse)
 async def list_books(
     q: Optional[str] = None,
+    prefix: bool = Query(False, description="Match q as a case-insensitive title prefix instead of a full-text search"),
     tag: Optional[str] = None,
     min_avg: Optional[float] = Query(None, ge=1, le=5, description="Minimum average rating"),
     year_from: Optional[int] = Query(None, ge=1000, le=2100, description="Start year"),
@@ -123,17 +250,20 @@ async def list_books(
     sort: str = Query("avg", regex="^(avg|ratings_count|year|title)$"),
     order: str = Query("desc", regex="^(asc|desc)$"),
     page: int = Query(1, ge=1),
-    page_size: int = Query(20, ge=1, le=100)
+    page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Token from next_cursor of the previous page")
 ):
     # Build filter
     filter_query = {}
     
-    # Text search
-    if q:
-        filter_query["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"authors": {"$regex": q, "$options": "i"}}
-        ]
+    # Prefix searches seek the collated title index as a range,
+    # everything else goes through the title/authors text index
+    collation = None
+    if q and prefix:
+        filter_query["title"] = {"$gte": q, "$lt": q + "\uffff"}
+        collation = TITLE_COLLATION
+    elif q:
+        filter_query["$text"] = {"$search": q}
     
     # Rating filter
     if min_avg is not None:
@@ -159,28 +289,36 @@ async def list_books(
     sort_field = sort_map.get(sort, "average_rating")
     sort_direction = -1 if order == "desc" else 1
     
-    # Get total count
-    total = db.books.count_documents(filter_query)
+    # Counting a filtered query costs a full index pass, so only report total when unfiltered
+    total = None if filter_query else await db.books.estimated_document_count()
     
-    # Get paginated results
-    skip = (page - 1) * page_size
-    books_cursor = db.books.find(filter_query).sort(sort_field, sort_direction).skip(skip).limit(page_size)
+    # Get paginated results, seeking past the cursor instead of skipping when one is given
+    sort_spec = [(sort_field, sort_direction), ("book_id", sort_direction)]
+    if cursor:
+        query = {"$and": [filter_query, build_keyset_filter(sort_field, sort_direction, cursor)]}
+        books_cursor = db.books.find(query, BOOK_LIST_FIELDS, collation=collation).sort(sort_spec).limit(page_size + 1)
+    else:
+        skip = (page - 1) * page_size
+        books_cursor = db.books.find(filter_query, BOOK_LIST_FIELDS, collation=collation).sort(sort_spec).skip(skip).limit(page_size + 1)
     
-    books = []
-    for book in books_cursor:
-        book["_id"] = str(book["_id"])
-        books.append(book)
+    # One extra document tells us whether another page exists without counting
+    books = await books_cursor.to_list(length=page_size + 1)
+    has_more = len(books) > page_size
+    books = books[:page_size]
+    next_cursor = encode_cursor(books[-1], sort_field) if has_more else None
     
     return {
         "items": books,
-        "page": page,
+        "page": None if cursor else page,
         "page_size": page_size,
-        "total": total
+        "total": total,
+        "has_more": has_more,
+        "next_cursor": next_cursor
     }
 
 @app.get("/books/{book_id}")
 async def get_book(book_id: int):
-    book = db.books.find_one({"book_id": book_id})
+    book = await db.books.find_one({"book_id": book_id})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
@@ -189,7 +327,7 @@ async def get_book(book_id: int):
 
 @app.get("/books/{book_id}/tags")
 async def get_book_tags(book_id: int):
-    book = db.books.find_one({"book_id": book_id})
+    book = await db.books.find_one({"book_id": book_id})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
@@ -212,7 +350,7 @@ async def get_book_tags(book_id: int):
         {"$sort": {"count": -1}}
     ]
     
-    tags = list(db.book_tags.aggregate(pipeline))
+    tags = await db.book_tags.aggregate(pipeline).to_list(length=None)
     
     for tag in tags:
         tag["_id"] = str(tag["_id"])
@@ -220,24 +358,33 @@ async def get_book_tags(book_id: int):
     return tags
 
 @app.get("/authors/{author_name}/books")
-async def get_author_books(author_name: str, page: int = Query(1, ge=1), page_size: int = Query(20, ge=1, le=100)):
+async def get_author_books(
+    author_name: str,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Token from next_cursor of the previous page")
+):
     filter_query = {"authors": {"$regex": author_name, "$options": "i"}}
     
-    total = db.books.count_documents(filter_query)
-    skip = (page - 1) * page_size
-    
-    books_cursor = db.books.find(filter_query).sort("average_rating", -1).skip(skip).limit(page_size)
+    sort_spec = [("average_rating", -1), ("book_id", -1)]
+    if cursor:
+        query = {"$and": [filter_query, build_keyset_filter("average_rating", -1, cursor)]}
+        books_cursor = db.books.find(query, BOOK_LIST_FIELDS).sort(sort_spec).limit(page_size + 1)
+    else:
+        skip = (page - 1) * page_size
+        books_cursor = db.books.find(filter_query, BOOK_LIST_FIELDS).sort(sort_spec).skip(skip).limit(page_size + 1)
     
-    books = []
-    for book in books_cursor:
-        book["_id"] = str(book["_id"])
-        books.append(book)
+    books = await books_cursor.to_list(length=page_size + 1)
+    has_more = len(books) > page_size
+    books = books[:page_size]
+    next_cursor = encode_cursor(books[-1], "average_rating") if has_more else None
     
     return {
         "items": books,
-        "page": page,
+        "page": None if cursor else page,
         "page_size": page_size,
-        "total": total
+        "has_more": has_more,
+        "next_cursor": next_cursor
     }
 
 # Tags endpoints
@@ -246,29 +393,14 @@ async def list_tags(
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100)
 ):
-    pipeline = [
-        {"$lookup": {
-            "from": "book_tags",
-            "localField": "tag_id",
-            "foreignField": "tag_id", 
-            "as": "book_links"
-        }},
-        {"$addFields": {
-            "book_count": {"$size": "$book_links"}
-        }},
-        {"$sort": {"book_count": -1}},
-        {"$skip": (page - 1) * page_size},
-        {"$limit": page_size},
-        {"$project": {
-            "tag_id": 1,
-            "tag_name": 1,
-            "book_count": 1
-        }}
-    ]
+    # book_count is precomputed at ingest time, so this is a plain indexed sort
+    tags_cursor = db.tags.find(
+        {}, {"tag_id": 1, "tag_name": 1, "book_count": 1}
+    ).sort("book_count", -1).skip((page - 1) * page_size).limit(page_size)
     
-    tags_with_counts = list(db.tags.aggregate(pipeline))
+    tags_with_counts = await tags_cursor.to_list(length=page_size)
     
-    total = db.tags.count_documents({})
+    total = await db.tags.estimated_document_count()
     
     for tag in tags_with_counts:
         tag["_id"] = str(tag["_id"])
@@ -277,25 +409,32 @@ async def list_tags(
         "items": tags_with_counts,
         "page": page,
         "page_size": page_size,
-        "total": total
+        "total": total,
+        "has_more": page * page_size < total
     }
 
 # User endpoints
 @app.get("/users/{user_id}/to-read")
 async def get_user_to_read(user_id: int):
-    to_read_books = list(db.to_read.find({"user_id": user_id}))
-    
-    book_ids = [item["book_id"] for item in to_read_books]
-    books = list(db.books.find({"book_id": {"$in": book_ids}}))
-    
-    for book in books:
-        book["_id"] = str(book["_id"])
+    # Join to_read straight onto books in one round trip
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$lookup": {
+            "from": "books",
+            "localField": "book_id",
+            "foreignField": "book_id",
+            "as": "book"
+        }},
+        {"$unwind": "$book"},
+        {"$replaceRoot": {"newRoot": "$book"}},
+        {"$project": BOOK_LIST_FIELDS}
+    ]
     
-    return books
+    return await db.to_read.aggregate(pipeline).to_list(length=None)
 
 @app.get("/books/{book_id}/ratings/summary")
 async def get_ratings_summary(book_id: int):
-    book = db.books.find_one({"book_id": book_id})
+    book = await db.books.find_one({"book_id": book_id})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
@@ -305,13 +444,15 @@ async def get_ratings_summary(book_id: int):
             "_id": "$book_id",
             "average_rating": {"$avg": "$rating"},
             "ratings_count": {"$sum": 1},
-            "histogram": {
-                "$push": "$rating"
+            # Bucket counts are computed server-side so the payload stays constant-size
+            **{
+                f"h{k}": {"$sum": {"$cond": [{"$eq": ["$rating", k]}, 1, 0]}}
+                for k in range(1, 6)
             }
         }}
     ]
     
-    result = list(db.ratings.aggregate(pipeline))
+    result = await db.ratings.aggregate(pipeline).to_list(length=1)
     
     if not result:
         return RatingSummary(
@@ -323,9 +464,7 @@ async def get_ratings_summary(book_id: int):
     
     stats = result[0]
     
-    histogram = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-    for rating in stats["histogram"]:
-        histogram[rating] += 1
+    histogram = {k: stats[f"h{k}"] for k in range(1, 6)}
     
     return RatingSummary(
         book_id=book_id,
@@ -335,13 +474,16 @@ async def get_ratings_summary(book_id: int):
     )
 
 # Protected endpoints
-@app.post("/ratings", response_model=dict)
-async def upsert_rating(rating: RatingIn, api_key: str = Depends(require_api_key)):
-    book = db.books.find_one({"book_id": rating.book_id})
+# The key is checked by the API key middleware; declared here so the schema documents it
+@app.post("/ratings", response_model=dict, openapi_extra={
+    "parameters": [{"name": "x-api-key", "in": "header", "required": True, "schema": {"type": "string"}}]
+})
+async def upsert_rating(rating: RatingIn):
+    book = await db.books.find_one({"book_id": rating.book_id})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    result = db.ratings.update_one(
+    result = await db.ratings.update_one(
         {"user_id": rating.user_id, "book_id": rating.book_id},
         {"$set": rating.dict()},
         upsert=True
@@ -358,32 +500,32 @@ async def get_recommendations(user_id: int, top_k: int = Query(20, ge=1, le=100)
     """
     Simple recommendation based on user's highly rated books and their tags
     """
-    # Get user's highly rated books
-    user_ratings = list(db.ratings.find({"user_id": user_id, "rating": {"$gte": 4}}))
+    # Collect the user's highly rated books and pick the best unrated ones in one pipeline
+    pipeline = [
+        {"$match": {"user_id": user_id, "rating": {"$gte": 4}}},
+        {"$group": {"_id": None, "ids": {"$addToSet": "$book_id"}}},
+        {"$lookup": {
+            "from": "books",
+            "let": {"ex": "$ids"},
+            "pipeline": [
+                {"$match": {"$expr": {"$not": {"$in": ["$book_id", "$$ex"]}}}},
+                {"$sort": {"average_rating": -1}},
+                {"$limit": top_k},
+                {"$project": BOOK_LIST_FIELDS}
+            ],
+            "as": "recs"
+        }},
+        {"$project": {"_id": 0, "recs": 1}}
+    ]
+    
+    result = await db.ratings.aggregate(pipeline).to_list(length=1)
     
-    if not user_ratings:
+    if not result:
         # If no ratings, return popular books
-        popular_books = list(db.books.find().sort("ratings_count", -1).limit(top_k))
-        books = []
-        for book in popular_books:
-            book["_id"] = str(book["_id"])
-            books.append(book)
-        return {"recommendations": books, "type": "popular"}
-    
-    # Get book IDs from user's ratings
-    rated_book_ids = [r["book_id"] for r in user_ratings]
-    
-    # Get books with similar tags (simplified approach)
-    recommended_books = list(db.books.find({
-        "book_id": {"$nin": rated_book_ids}
-    }).sort("average_rating", -1).limit(top_k))
-    
-    books = []
-    for book in recommended_books:
-        book["_id"] = str(book["_id"])
-        books.append(book)
-    
-    return {"recommendations": books, "type": "based_on_ratings"}
+        popular_books = await db.books.find({}, BOOK_LIST_FIELDS).sort("ratings_count", -1).limit(top_k).to_list(length=top_k)
+        return {"recommendations": popular_books, "type": "popular"}
+    
+    return {"recommendations": result[0]["recs"], "type": "based_on_ratings"}
 
 # Error handlers
 @app.exception_handler(HTTPException)
@@ -43,9 +43,11 @@ class ToRead(BaseModel):
 
 class PaginatedResponse(BaseModel):
     items: List[Any]
-    page: int
+    page: Optional[int] = None
     page_size: int
-    total: int
+    total: Optional[int] = None
+    has_more: bool = False
+    next_cursor: Optional[str] = None
 
 class RatingSummary(BaseModel):
     book_id: int
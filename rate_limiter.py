@@ -1,39 +1,90 @@
-from fastapi import HTTPException, Request
+from fastapi import Request
+from fastapi.responses import JSONResponse
+import logging
+import os
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Shared counters across workers when Redis is configured, in-process otherwise
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
 
 class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
+    def __init__(self, sweep_interval: int = 60):
+        self.requests = defaultdict(deque)
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
     
     def is_rate_limited(self, key: str, limit: int, window: int):
+        """Record a request for key and return (limited, remaining)"""
         now = time.time()
-        self.requests[key] = [req_time for req_time in self.requests[key] if now - req_time < window]
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now, window)
+        
+        # Timestamps are appended in order, so expired ones are always at the left
+        timestamps = self.requests[key]
+        while timestamps and now - timestamps[0] >= window:
+            timestamps.popleft()
         
-        if len(self.requests[key]) >= limit:
-            return True
+        if len(timestamps) >= limit:
+            return True, 0
         
-        self.requests[key].append(now)
-        return False
+        timestamps.append(now)
+        return False, limit - len(timestamps)
+    
+    def sweep(self, now: float, window: int):
+        """Drop keys whose requests have all expired so idle clients don't accumulate"""
+        expired = [key for key, timestamps in self.requests.items() if not timestamps or now - timestamps[-1] >= window]
+        for key in expired:
+            del self.requests[key]
+        self.last_sweep = now
 
 rate_limiter = RateLimiter()
 
+async def redis_rate_limit(key: str, limit: int, window: int):
+    """Fixed-window counter in Redis; return (limited, remaining)"""
+    bucket = f"rl:{key}:{int(time.time() // window)}"
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.incr(bucket)
+    pipe.expire(bucket, window)
+    count, _ = await pipe.execute()
+    
+    return count > limit, max(0, limit - count)
+
 async def rate_limit_middleware(request: Request, call_next):
-    # Skip rate limiting for health checks
-    if request.url.path in ["/healthz", "/metrics", "/docs", "/openapi.json"]:
+    # Skip rate limiting for health checks and CORS preflights, which would
+    # otherwise share a budget with the request they precede
+    if request.method == "OPTIONS" or request.url.path in ["/healthz", "/metrics", "/docs", "/openapi.json"]:
         return await call_next(request)
     
     client_ip = request.client.host if request.client else "unknown"
     rate_limit_key = f"{client_ip}:{request.url.path}"
     
     # 60 requests per minute per IP
-    if rate_limiter.is_rate_limited(rate_limit_key, limit=60, window=60):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded. Maximum 60 requests per minute.")
+    limited = None
+    if redis_client is not None:
+        try:
+            limited, remaining = await redis_rate_limit(rate_limit_key, limit=60, window=60)
+        except redis.RedisError as e:
+            # A Redis outage must not take the API down with it
+            logger.warning(f"Redis rate limiting unavailable, using in-process limiter: {str(e)}")
+    if limited is None:
+        limited, remaining = rate_limiter.is_rate_limited(rate_limit_key, limit=60, window=60)
+    if limited:
+        # Exceptions raised in middleware bypass the exception handlers, so respond directly
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Rate limit exceeded. Maximum 60 requests per minute."}
+        )
     
     response = await call_next(request)
     
     # Add rate limit headers
     response.headers["X-RateLimit-Limit"] = "60"
-    response.headers["X-RateLimit-Remaining"] = str(60 - len(rate_limiter.requests[rate_limit_key]))
+    response.headers["X-RateLimit-Remaining"] = str(remaining)
     
     return response
\ No newline at end of file
@@ -6,23 +6,33 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
 
-from main import app
+from main import app, encode_cursor, decode_cursor, build_keyset_filter
+from fastapi import HTTPException
+import redis.asyncio as redis
+import rate_limiter as rate_limiter_module
+from rate_limiter import RateLimiter
+import base64
+import json
 
-client = TestClient(app)
+# Entering the client runs the app lifespan, so every request shares one event loop
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as test_client:
+        yield test_client
 
-def test_health_check():
+def test_health_check(client):
     response = client.get("/healthz")
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
-def test_metrics():
+def test_metrics(client):
     response = client.get("/metrics")
     assert response.status_code == 200
     data = response.json()
     assert "collections" in data
     assert "books" in data["collections"]
 
-def test_list_books():
+def test_list_books(client):
     response = client.get("/books?page=1&page_size=5")
     assert response.status_code == 200
     data = response.json()
@@ -30,42 +40,82 @@ def test_list_books():
     assert "page" in data
     assert "total" in data
 
-def test_get_book():
+def test_list_books_cursor_matches_page_two(client):
+    first = client.get("/books?page=1&page_size=5").json()
+    assert first["has_more"] is True
+    assert first["next_cursor"]
+    
+    by_cursor = client.get(f"/books?page_size=5&cursor={first['next_cursor']}")
+    assert by_cursor.status_code == 200
+    by_page = client.get("/books?page=2&page_size=5").json()
+    assert by_cursor.json()["items"] == by_page["items"]
+    assert by_cursor.json()["page"] is None
+
+def test_list_books_invalid_cursor(client):
+    response = client.get("/books?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+def test_list_books_total_only_when_unfiltered(client):
+    unfiltered = client.get("/books?page_size=5").json()
+    assert isinstance(unfiltered["total"], int)
+    
+    filtered = client.get("/books?min_avg=4&page_size=5").json()
+    assert filtered["total"] is None
+    assert isinstance(filtered["has_more"], bool)
+    assert len(filtered["items"]) <= 5
+
+def test_list_books_last_page_has_no_more(client):
+    total = client.get("/books?page_size=100").json()["total"]
+    last_page = (total + 99) // 100
+    data = client.get(f"/books?page={last_page}&page_size=100").json()
+    assert data["has_more"] is False
+    assert data["next_cursor"] is None
+
+def test_get_book(client):
     response = client.get("/books/1")
     assert response.status_code == 200
     data = response.json()
     assert "book_id" in data
 
-def test_get_book_tags():
+def test_get_book_tags(client):
     response = client.get("/books/1/tags")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
-def test_get_author_books():
+def test_get_author_books(client):
     response = client.get("/authors/Suzanne/books")
     assert response.status_code == 200
     data = response.json()
     assert "items" in data
 
-def test_list_tags():
+def test_get_author_books_cursor_matches_page_two(client):
+    first = client.get("/authors/Suzanne/books?page=1&page_size=1").json()
+    if not first["has_more"]:
+        pytest.skip("Not enough books by this author for a second page")
+    
+    by_cursor = client.get(f"/authors/Suzanne/books?page_size=1&cursor={first['next_cursor']}").json()
+    by_page = client.get("/authors/Suzanne/books?page=2&page_size=1").json()
+    assert by_cursor["items"] == by_page["items"]
+
+def test_list_tags(client):
     response = client.get("/tags")
     assert response.status_code == 200
     data = response.json()
     assert "items" in data
 
-def test_get_user_to_read():
+def test_get_user_to_read(client):
     response = client.get("/users/1/to-read")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
-def test_get_ratings_summary():
+def test_get_ratings_summary(client):
     response = client.get("/books/1/ratings/summary")
     assert response.status_code == 200
     data = response.json()
     assert "average_rating" in data
     assert "histogram" in data
 
-def test_create_rating_with_auth():
+def test_create_rating_with_auth(client):
     rating_data = {
         "user_id": 999,
         "book_id": 1,
@@ -78,14 +128,185 @@ def test_create_rating_with_auth():
     )
     assert response.status_code in [200, 201]
 
-def test_get_recommendations():
+def test_create_rating_without_auth(client):
+    rating_data = {
+        "user_id": 999,
+        "book_id": 1,
+        "rating": 5
+    }
+    response = client.post("/ratings", json=rating_data)
+    assert response.status_code == 401
+    
+    response = client.post(
+        "/ratings",
+        json=rating_data,
+        headers={"x-api-key": "wrong-key"}
+    )
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Invalid API key"
+
+def test_create_rating_without_auth_has_cors_headers(client):
+    response = client.post(
+        "/ratings",
+        json={"user_id": 999, "book_id": 1, "rating": 5},
+        headers={"Origin": "http://example.com"}
+    )
+    assert response.status_code == 401
+    assert "access-control-allow-origin" in response.headers
+
+def test_ratings_schema_documents_api_key(client):
+    parameters = client.get("/openapi.json").json()["paths"]["/ratings"]["post"]["parameters"]
+    assert {"name": "x-api-key", "in": "header", "required": True, "schema": {"type": "string"}} in parameters
+
+def test_get_recommendations(client):
     response = client.get("/users/1/recommendations?top_k=5")
     assert response.status_code == 200
     data = response.json()
     assert "recommendations" in data
     assert "type" in data
 
-def test_root_endpoint():
+def test_root_endpoint(client):
+    response = client.get("/")
+    assert response.status_code == 200
+    assert response.json()["message"] == "GoodBooks API is running"
+
+def test_rate_limit_skips_options(client):
+    for _ in range(61):
+        response = client.options("/rate-limit-options-probe")
+        assert response.status_code != 429
+
+def test_rate_limited_response_has_cors_headers(client):
+    for _ in range(60):
+        client.get("/rate-limit-cors-probe")
+    response = client.get("/rate-limit-cors-probe", headers={"Origin": "http://example.com"})
+    assert response.status_code == 429
+    assert "access-control-allow-origin" in response.headers
+
+def test_rate_limiter_counts_down_and_limits(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module.time, "time", lambda: 1000.0)
+    limiter = RateLimiter()
+    assert limiter.is_rate_limited("k", limit=3, window=60) == (False, 2)
+    assert limiter.is_rate_limited("k", limit=3, window=60) == (False, 1)
+    assert limiter.is_rate_limited("k", limit=3, window=60) == (False, 0)
+    assert limiter.is_rate_limited("k", limit=3, window=60) == (True, 0)
+
+def test_rate_limiter_window_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter_module.time, "time", lambda: now[0])
+    limiter = RateLimiter()
+    limiter.is_rate_limited("k", limit=2, window=60)
+    now[0] = 1030.0
+    limiter.is_rate_limited("k", limit=2, window=60)
+    assert limiter.is_rate_limited("k", limit=2, window=60) == (True, 0)
+    
+    # Only the first request has aged out of the window
+    now[0] = 1060.0
+    assert limiter.is_rate_limited("k", limit=2, window=60) == (False, 0)
+    assert list(limiter.requests["k"]) == [1030.0, 1060.0]
+
+def test_rate_limiter_sweeps_idle_keys(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter_module.time, "time", lambda: now[0])
+    limiter = RateLimiter(sweep_interval=60)
+    limiter.is_rate_limited("idle", limit=5, window=60)
+    now[0] = 1050.0
+    limiter.is_rate_limited("active", limit=5, window=60)
+    
+    now[0] = 1070.0
+    limiter.is_rate_limited("active", limit=5, window=60)
+    assert "idle" not in limiter.requests
+    assert "active" in limiter.requests
+
+class FakeRedisPipeline:
+    def __init__(self, store, fail):
+        self.store = store
+        self.fail = fail
+        self.key = None
+    
+    def incr(self, key):
+        self.key = key
+    
+    def expire(self, key, seconds):
+        pass
+    
+    async def execute(self):
+        if self.fail:
+            raise redis.ConnectionError("Redis is down")
+        self.store[self.key] = self.store.get(self.key, 0) + 1
+        return [self.store[self.key], True]
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.store = {}
+        self.fail = fail
+    
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self.store, self.fail)
+
+def test_rate_limit_uses_redis_counter(client, monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(rate_limiter_module, "redis_client", fake)
     response = client.get("/")
     assert response.status_code == 200
-    assert response.json()["message"] == "GoodBooks API is running"
\ No newline at end of file
+    assert response.headers["X-RateLimit-Remaining"] == "59"
+    assert list(fake.store.values()) == [1]
+
+def test_rate_limit_falls_back_when_redis_fails(client, monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "redis_client", FakeRedis(fail=True))
+    response = client.get("/redis-fallback-probe")
+    assert response.status_code == 404
+    assert response.headers["X-RateLimit-Remaining"] == "59"
+
+def make_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def test_cursor_round_trip():
+    cursor = encode_cursor({"average_rating": 4.5, "book_id": 7}, "average_rating")
+    assert decode_cursor(cursor) == (4.5, 7)
+
+def test_cursor_round_trip_missing_sort_value():
+    cursor = encode_cursor({"book_id": 7}, "original_publication_year")
+    assert decode_cursor(cursor) == (None, 7)
+
+@pytest.mark.parametrize("cursor", [
+    "not-base64!",
+    make_cursor("just a string"),
+    make_cursor([4.5]),
+    make_cursor([4.5, "7"]),
+    make_cursor([4.5, True]),
+    make_cursor([{"$ne": None}, 5]),
+    make_cursor([[1, 2], 5]),
+    make_cursor([True, 5]),
+])
+def test_decode_cursor_rejects_malformed(cursor):
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(cursor)
+    assert exc.value.status_code == 400
+
+def test_keyset_filter_desc():
+    cursor = make_cursor([4.5, 7])
+    assert build_keyset_filter("average_rating", -1, cursor) == {"$or": [
+        {"average_rating": {"$lt": 4.5}},
+        {"average_rating": 4.5, "book_id": {"$lt": 7}},
+        {"average_rating": None}
+    ]}
+
+def test_keyset_filter_asc():
+    cursor = make_cursor(["Dune", 7])
+    assert build_keyset_filter("title", 1, cursor) == {"$or": [
+        {"title": {"$gt": "Dune"}},
+        {"title": "Dune", "book_id": {"$gt": 7}}
+    ]}
+
+def test_keyset_filter_null_desc():
+    cursor = make_cursor([None, 7])
+    assert build_keyset_filter("original_publication_year", -1, cursor) == {
+        "original_publication_year": None, "book_id": {"$lt": 7}
+    }
+
+def test_keyset_filter_null_asc():
+    cursor = make_cursor([None, 7])
+    assert build_keyset_filter("original_publication_year", 1, cursor) == {"$or": [
+        {"original_publication_year": None, "book_id": {"$gt": 7}},
+        {"original_publication_year": {"$ne": None}}
+    ]}